@@ -23,64 +23,110 @@ No field names are hard-coded—the script simply follows the HTML’s
 class markers—so it’s flexible for any “printable” ASRS result page
 (or anything that re-uses those classes).
 """
+import os
 import sys
+import html
 import json
 import pathlib
-from bs4 import BeautifulSoup
+import re
+import textwrap
+from lxml import etree
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_RECORD_CLASSES = {"acnheading", "acnsection", "acndata"}
+
+
+def _text(element):
+    """Return the whitespace-normalised text content of *element*."""
+    return " ".join("".join(element.itertext()).split())
+
+
+def _clean(line):
+    """Return the text of an HTML fragment, like BeautifulSoup's get_text(" ", strip=True)."""
+    # Split on tags before unescaping so escaped text such as "&lt;N/A&gt;" survives.
+    pieces = (html.unescape(part).strip() for part in _TAG_RE.split(line))
+    return " ".join(piece for piece in pieces if piece)
 
 
 def _parse_acndata_block(tag):
-    """Return a list of cleaned text lines from a <p class="acndata"> tag."""
-    raw_lines = tag.decode_contents().split("<br>")
-    return [
-        BeautifulSoup(line, "html.parser").get_text(" ", strip=True)
-        for line in raw_lines
-        if line.strip()
-    ]
-
-
-def _extract_records(soup):
-    records = []
-    for heading in soup.find_all("p", class_="acnheading"):
-        record = {}
-
-        # Example heading text: "ACN: 2184152 (1 of 91)"
-        acn_text = heading.get_text(" ", strip=True)
-        if ":" in acn_text:
-            record["ACN"] = acn_text.split(":", 1)[1].split()[0]
-
-        section_name = None
-        for sib in heading.find_next_siblings("p"):
-            cls = sib.get("class", [])
-            if "acnheading" in cls:
-                break  # Reached next record
-
-            if "acnsection" in cls:
-                section_name = sib.get_text(" ", strip=True).rstrip(":")
-                record[section_name] = {}
-            elif "acndata" in cls and section_name:
-                lines = _parse_acndata_block(sib)
-                for line in lines:
-                    if " : " in line:
-                        key, val = map(str.strip, line.split(" : ", 1))
-                        # Preserve duplicates as lists
-                        if key in record[section_name]:
-                            prev = record[section_name][key]
-                            record[section_name][key] = (
-                                prev + [val] if isinstance(prev, list) else [prev, val]
-                            )
-                        else:
-                            record[section_name][key] = val
-                    else:  # Narrative / free text
-                        record[section_name].setdefault("text", []).append(line)
-
-        # Flatten narrative lists into single strings
-        for sec in record.values():
-            if isinstance(sec, dict) and "text" in sec:
-                sec["text"] = "\n".join(sec["text"])
-
-        records.append(record)
-    return records
+    """Return a list of cleaned text lines from a <p class="acndata"> element."""
+    inner_html = html.escape(tag.text or "", quote=False) + "".join(
+        etree.tostring(child, method="html", encoding="unicode") for child in tag
+    )
+    raw_lines = inner_html.split("<br>")
+    return [_clean(line) for line in raw_lines if line.strip()]
+
+
+def _iter_record_paragraphs(path):
+    """
+    Yield (classes, element) for each record <p> in document order while
+    streaming the file, discarding every paragraph once it has been handled
+    so memory stays bounded by a single record.  An empty document yields
+    nothing rather than raising.
+    """
+    seen_paragraph = False
+    try:
+        for _, p in etree.iterparse(str(path), events=("end",), tag="p", html=True, encoding="utf-8"):
+            seen_paragraph = True
+            cls = set(p.get("class", "").split()) & _RECORD_CLASSES
+            if cls:
+                yield cls, p
+            p.clear(keep_tail=True)
+            while p.getprevious() is not None:
+                del p.getparent()[0]
+    except etree.XMLSyntaxError:
+        # libxml2 reports "no element found" for a file with no markup at all.
+        if seen_paragraph:
+            raise
+
+
+def _finish_record(record):
+    """Flatten narrative lists into single strings."""
+    for sec in record.values():
+        if isinstance(sec, dict) and "text" in sec:
+            sec["text"] = "\n".join(sec["text"])
+    return record
+
+
+def stream_records(path):
+    """Yield the records of an ASRS printable HTML file one at a time."""
+    record = None
+    section_name = None
+    for cls, p in _iter_record_paragraphs(path):
+        if "acnheading" in cls:
+            if record is not None:
+                yield _finish_record(record)
+            record = {}
+            section_name = None
+
+            # Example heading text: "ACN: 2184152 (1 of 91)"
+            acn_text = _text(p)
+            if ":" in acn_text:
+                record["ACN"] = acn_text.split(":", 1)[1].split()[0]
+        elif record is None:
+            continue  # Not inside a record yet
+
+        elif "acnsection" in cls:
+            section_name = _text(p).rstrip(":")
+            record[section_name] = {}
+        elif "acndata" in cls and section_name:
+            lines = _parse_acndata_block(p)
+            for line in lines:
+                if " : " in line:
+                    key, val = map(str.strip, line.split(" : ", 1))
+                    # Preserve duplicates as lists
+                    if key in record[section_name]:
+                        prev = record[section_name][key]
+                        record[section_name][key] = (
+                            prev + [val] if isinstance(prev, list) else [prev, val]
+                        )
+                    else:
+                        record[section_name][key] = val
+                else:  # Narrative / free text
+                    record[section_name].setdefault("text", []).append(line)
+
+    if record is not None:
+        yield _finish_record(record)
 
 
 def main() -> None:
@@ -95,15 +141,20 @@ def main() -> None:
         else in_path.with_suffix(".json")
     )
 
-    with in_path.open("r", encoding="utf-8", errors="ignore") as f:
-        soup = BeautifulSoup(f, "html.parser")
-
-    data = _extract_records(soup)
-
-    with out_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
-    print(f"Wrote {len(data)} record(s) to {out_path}")
+    # Write the JSON array one record at a time; the layout matches json.dump(records, f, indent=2).
+    # Stream into a temporary file so a parse error never clobbers an existing output file.
+    tmp_path = out_path.with_suffix(".tmp")
+    count = 0
+    with tmp_path.open("w", encoding="utf-8") as f:
+        f.write("[")
+        for record in stream_records(in_path):
+            f.write(",\n" if count else "\n")
+            f.write(textwrap.indent(json.dumps(record, indent=2), "  "))
+            count += 1
+        f.write("\n]" if count else "]")
+    os.replace(tmp_path, out_path)
+
+    print(f"Wrote {count} record(s) to {out_path}")
 
 
 if __name__ == "__main__":
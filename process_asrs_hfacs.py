@@ -1,20 +1,53 @@
 import openai
+import httpx
+import asyncio
 import json
+import random
 import time
 import os
 import argparse
-from typing import List, Dict, Any, Tuple
+import functools
+import hashlib
+import re
+import sqlite3
+from typing import List, Dict, Any, Tuple, Callable, Optional
 import tiktoken # For token counting
+try:
+    import orjson # Optional: much faster loading/saving of large incident files
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers only need to catch the latter.
+json_loads = orjson.loads if orjson else json.loads
+
+
+def json_dumps_compact(obj: Any) -> str:
+    """Serializes `obj` without indentation or padding, for files that are rewritten or appended to often."""
+    if orjson:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(",", ":"))
 
 # --- Configuration ---
 # Load API key from environment variable for security
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 MODEL_NAME = "o3-2025-04-16" # As specified by you
-REQUEST_DELAY_SECONDS = 1  # Delay between API calls to respect rate limits
-
-# --- HFACS Prompt Template ---
-HFACS_PROMPT_TEMPLATE = """
-**Project Context & Goal:**
+DEFAULT_CONCURRENCY = 5  # Maximum number of in-flight API requests
+DEFAULT_REQUESTS_PER_MINUTE = 60  # Client-side request rate limit
+DEFAULT_TOKENS_PER_MINUTE = 200_000  # Client-side token rate limit (input + estimated output)
+MAX_RETRIES = 5  # Retries for rate-limit, timeout, connection and server errors
+RETRY_BASE_DELAY_SECONDS = 1  # Base delay for exponential backoff with jitter
+RATE_LIMIT_COOLDOWN_SECONDS = 15  # Pause for all requests after the API returns a 429
+LOW_REMAINING_REQUESTS = 5  # Wait for the server's rate-limit window to reset below this many remaining requests
+DEFAULT_BATCH_SIZE = 1  # Narratives per API request; 1 classifies each record on its own
+DEFAULT_MAX_BATCH_INPUT_TOKENS = 50_000  # Input-token budget for a single batched request
+DEFAULT_MAX_INPUT_TOKENS = 6000  # Longer narratives are truncated to this many tokens (0 disables truncation)
+DEFAULT_CACHE_FILE = "hfacs_cache.db"  # SQLite cache of LLM responses, so reruns don't pay for the same prompt twice
+
+# --- HFACS Prompt Templates ---
+# The static instructions and few-shot examples go in a developer message that is identical for every
+# request, so OpenAI's prompt caching can reuse it; only the narrative(s) change in the user message.
+# Shared sections are kept as separate strings so the single-narrative and batch prompts stay in sync.
+HFACS_BACKGROUND = """**Project Context & Goal:**
 
 We are working on a project to enhance aviation safety analysis by automating the classification of incident narratives from the Aviation Safety Reporting System (ASRS) into the Human Factors Analysis and Classification System (HFACS) framework. The goal is to improve the efficiency, consistency, and depth of insights gained from post-flight debriefs and safety investigations by systematically identifying human factors contributing to incidents. Your task is to act as an expert aviation safety analyst and classify the provided narrative into the HFACS categories.
 
@@ -26,69 +59,39 @@ HFACS is a hierarchical framework used to identify human error in aviation incid
 3.  **Unsafe Supervision:** Failures by direct supervisors (Inadequate Supervision, Planned Inappropriate Operations, Failure to Correct Known Problem, Supervisory Violations).
 4.  **Organizational Influences:** High-level systemic failures (Resource Management, Organizational Climate, Operational Process).
 
-**Your Task: HFACS Classification for the following narrative:**
-
-Narrative:
----
-{narrative_text}
----
-
-Please:
-1.  Carefully read and analyze the narrative text provided above.
-2.  Identify all relevant contributing factors according to the HFACS framework. An incident can, and often will, have multiple HFACS categories applicable.
-3.  For each identified HFACS category, please provide the specific sub-category where possible (e.g., instead of just "Errors," specify "Skill-Based Errors" or "Decision Errors").
-4.  Output your classification for THIS SINGLE INCIDENT NARRATIVE in the following JSON format (provide only the JSON list of classifications, nothing else):
-
-**Desired JSON Output Format (a list of classification objects):**
-```json
-[
-  {{
-    "level": "Unsafe Acts of Operators",
-    "category": "Errors",
-    "sub_category": "Skill-Based Errors",
-    "justification_from_narrative": "Brief quote or summary from the narrative supporting this classification."
-  }},
-  {{
-    "level": "Preconditions for Unsafe Acts",
-    "category": "Environmental Factors",
-    "sub_category": "Physical Environment",
-    "justification_from_narrative": "Quote/summary supporting this."
-  }}
-  // ... (more HFACS classifications as applicable for THIS narrative) ...
-]
-```
+"""
 
-**Few-Shot Examples to Guide Your Classification:**
+HFACS_FEW_SHOT_EXAMPLES = """**Few-Shot Examples to Guide Your Classification:**
 
 **Example 1:**
 *Narrative Snippet:* "During preflight, I misread the fuel gauge due to poor lighting in the hangar and the gauge's small font. I was also feeling rushed because we were behind schedule."
 *Expected JSON Output for this example:*
 ```json
 [
-  {{
+  {
     "level": "Unsafe Acts of Operators",
     "category": "Errors",
     "sub_category": "Perceptual Errors",
     "justification_from_narrative": "Pilot misread the fuel gauge."
-  }},
-  {{
+  },
+  {
     "level": "Preconditions for Unsafe Acts",
     "category": "Environmental Factors",
     "sub_category": "Physical Environment",
     "justification_from_narrative": "Poor lighting in the hangar."
-  }},
-  {{
+  },
+  {
     "level": "Preconditions for Unsafe Acts",
     "category": "Environmental Factors",
     "sub_category": "Technological Environment",
     "justification_from_narrative": "Gauge's small font."
-  }},
-  {{
+  },
+  {
     "level": "Preconditions for Unsafe Acts",
     "category": "Condition of Operators",
     "sub_category": "Adverse Mental States",
     "justification_from_narrative": "Feeling rushed because we were behind schedule."
-  }}
+  }
 ]
 ```
 
@@ -97,34 +100,112 @@ Please:
 *Expected JSON Output for this example:*
 ```json
 [
-  {{
+  {
     "level": "Unsafe Acts of Operators",
     "category": "Errors",
     "sub_category": "Decision Errors",
     "justification_from_narrative": "Obvious confusion during a critical phase implies difficulty in decision-making."
-  }},
-  {{
+  },
+  {
     "level": "Preconditions for Unsafe Acts",
     "category": "Personnel Factors",
     "sub_category": "Crew Resource Management Issues",
     "justification_from_narrative": "First Officer seemed hesitant to speak up."
-  }},
-  {{
+  },
+  {
     "level": "Unsafe Supervision",
     "category": "Inadequate Supervision",
     "justification_from_narrative": "Training on this specific scenario was minimal (implies supervisory oversight of training adequacy)."
-  }},
-  {{
+  },
+  {
     "level": "Organizational Influences",
     "category": "Operational Process",
     "justification_from_narrative": "Company procedure for a go-around was unclear in the ops manual."
-  }}
+  }
+]
+```
+
+"""
+
+HFACS_SYSTEM_PROMPT = "\n" + HFACS_BACKGROUND + """**Your Task: HFACS Classification for the narrative provided in the user message:**
+
+Please:
+1.  Carefully read and analyze the narrative text provided in the user message.
+2.  Identify all relevant contributing factors according to the HFACS framework. An incident can, and often will, have multiple HFACS categories applicable.
+3.  For each identified HFACS category, please provide the specific sub-category where possible (e.g., instead of just "Errors," specify "Skill-Based Errors" or "Decision Errors").
+4.  Output your classification for THIS SINGLE INCIDENT NARRATIVE in the following JSON format (provide only the JSON list of classifications, nothing else):
+
+**Desired JSON Output Format (a list of classification objects):**
+```json
+[
+  {
+    "level": "Unsafe Acts of Operators",
+    "category": "Errors",
+    "sub_category": "Skill-Based Errors",
+    "justification_from_narrative": "Brief quote or summary from the narrative supporting this classification."
+  },
+  {
+    "level": "Preconditions for Unsafe Acts",
+    "category": "Environmental Factors",
+    "sub_category": "Physical Environment",
+    "justification_from_narrative": "Quote/summary supporting this."
+  }
+  // ... (more HFACS classifications as applicable for THIS narrative) ...
 ]
 ```
 
-Now, please provide the JSON list of classifications ONLY for the main narrative provided under "Your Task".
+""" + HFACS_FEW_SHOT_EXAMPLES + """Now, please provide the JSON list of classifications ONLY for the narrative provided in the user message.
+"""
+
+HFACS_USER_TEMPLATE = """Narrative:
+---
+{narrative_text}
+---"""
+
+# Batch variant: several narratives per request, answered as a JSON object keyed by narrative ID.
+HFACS_BATCH_SYSTEM_PROMPT = "\n" + HFACS_BACKGROUND + """**Your Task: HFACS Classification for each of the narratives provided in the user message:**
+
+The user message contains a JSON list of objects, each with an "id" and the narrative "text".
+
+Please:
+1.  Carefully read and analyze each narrative independently. Do not let one narrative influence the classification of another.
+2.  Identify all relevant contributing factors according to the HFACS framework. An incident can, and often will, have multiple HFACS categories applicable.
+3.  For each identified HFACS category, please provide the specific sub-category where possible (e.g., instead of just "Errors," specify "Skill-Based Errors" or "Decision Errors").
+4.  Output your classifications as a single JSON object whose keys are the narrative "id" values and whose values are the list of classification objects for that narrative (provide only the JSON object, nothing else). Include every "id", using an empty list if no HFACS category applies.
+
+**Desired JSON Output Format (an object mapping each narrative id to its list of classification objects):**
+```json
+{
+  "<id of first narrative>": [
+    {
+      "level": "Unsafe Acts of Operators",
+      "category": "Errors",
+      "sub_category": "Skill-Based Errors",
+      "justification_from_narrative": "Brief quote or summary from the narrative supporting this classification."
+    }
+    // ... (more HFACS classifications as applicable for this narrative) ...
+  ],
+  "<id of second narrative>": [
+    // ... (HFACS classifications for this narrative) ...
+  ]
+}
+```
+
+The examples below show the classification list for a single narrative; in your answer, each such list is the value for that narrative's "id".
+
+""" + HFACS_FEW_SHOT_EXAMPLES + """Now, please provide the JSON object of classifications for every narrative provided in the user message.
 """
 
+HFACS_BATCH_USER_TEMPLATE = """Narratives:
+---
+{narratives_json}
+---"""
+
+# The user templates are pre-split around their single placeholder so building a prompt is a plain
+# concatenation instead of re-parsing the template with str.format on every call.
+_USER_PREFIX, _USER_SUFFIX = HFACS_USER_TEMPLATE.split("{narrative_text}")
+_BATCH_USER_PREFIX, _BATCH_USER_SUFFIX = HFACS_BATCH_USER_TEMPLATE.split("{narratives_json}")
+
 # --- Token Counting and Cost Estimation ---
 # Pricing for o3-2025-04-16 (as per your information)
 INPUT_COST_PER_MILLION_TOKENS = 10.00
@@ -137,8 +218,12 @@ OUTPUT_COST_PER_MILLION_TOKENS = 40.00
 # This is a very rough guess and can vary wildly.
 ESTIMATED_AVERAGE_OUTPUT_TOKENS_PER_CALL = 1000 # Increased estimate, includes reasoning and actual JSON.
 
+@functools.lru_cache(maxsize=4)
 def get_tokenizer_for_model(model_name: str) -> tiktoken.Encoding:
-    """Returns the tiktoken encoding for the given model."""
+    """
+    Returns the tiktoken encoding for the given model.
+    Cached, since building an Encoding loads the whole BPE merge table.
+    """
     try:
         # For "o3" models, "o200k_base" is likely the correct encoding family
         # based on gpt-4o using it. If OpenAI specifies directly for o3, update this.
@@ -149,14 +234,46 @@ def get_tokenizer_for_model(model_name: str) -> tiktoken.Encoding:
         print(f"Warning: Model '{model_name}' not found in tiktoken. Using 'o200k_base' as a fallback.")
         return tiktoken.get_encoding("o200k_base")
 
-def count_tokens_for_prompt(prompt_text: str, model_name: str) -> int:
-    """Counts the number of tokens for a given prompt text and model."""
-    encoder = get_tokenizer_for_model(model_name)
-    return len(encoder.encode(prompt_text))
+_ENCODER = get_tokenizer_for_model(MODEL_NAME)
+# The templates are constant, so their tokens are counted once; per call only the narrative text is encoded.
+# BPE merges across the template/narrative boundary can shift the total by a token or two, which is fine for estimates.
+_STATIC_TEMPLATE_TOKENS = len(_ENCODER.encode(HFACS_SYSTEM_PROMPT)) + len(_ENCODER.encode(_USER_PREFIX + _USER_SUFFIX))
+_STATIC_BATCH_TEMPLATE_TOKENS = len(_ENCODER.encode(HFACS_BATCH_SYSTEM_PROMPT)) + len(_ENCODER.encode(_BATCH_USER_PREFIX + _BATCH_USER_SUFFIX))
+
+def count_tokens_for_prompt(narrative_text: str) -> int:
+    """Counts the number of tokens in the HFACS prompt built around the given narrative."""
+    return _STATIC_TEMPLATE_TOKENS + len(_ENCODER.encode(narrative_text))
+
+def count_tokens_for_batch_prompt(narratives_json: str) -> int:
+    """Counts the number of tokens in the batch HFACS prompt built around the given narratives JSON."""
+    return _STATIC_BATCH_TEMPLATE_TOKENS + len(_ENCODER.encode(narratives_json))
+
+def count_tokens_for_texts(texts: List[str]) -> List[int]:
+    """
+    Counts the tokens of many texts at once. encode_batch tokenizes on a thread pool inside
+    tiktoken (which releases the GIL), so this stays fast for large slices.
+    """
+    return [len(token_ids) for token_ids in _ENCODER.encode_batch(texts, num_threads=os.cpu_count() or 1)]
+
+def truncate_to_token_budget(texts: List[str], max_tokens: int) -> Tuple[List[str], List[int]]:
+    """
+    Cuts each text longer than `max_tokens` tokens (when `max_tokens` > 0) to its first `max_tokens` tokens.
+    All texts are tokenized in a single encode_batch call and only the over-budget ones are decoded.
+    Returns the texts, with those that fit left as the same objects, and their token counts.
+    """
+    result_texts = []
+    token_counts = []
+    for text, token_ids in zip(texts, _ENCODER.encode_batch(texts, num_threads=os.cpu_count() or 1)):
+        if 0 < max_tokens < len(token_ids):
+            result_texts.append(_ENCODER.decode(token_ids[:max_tokens]))
+            token_counts.append(max_tokens)
+        else:
+            result_texts.append(text)
+            token_counts.append(len(token_ids))
+    return result_texts, token_counts
 
-def estimate_cost(num_incidents: int, average_input_tokens_per_incident: int) -> Tuple[float, int, int]:
-    """Estimates the cost for processing a number of incidents."""
-    total_input_tokens = num_incidents * average_input_tokens_per_incident
+def estimate_cost(num_incidents: int, total_input_tokens: int) -> Tuple[float, int, int]:
+    """Estimates the cost for processing a number of incidents given their total input tokens."""
     # Reasoning tokens are billed as output tokens.
     # The actual output token count will include both reasoning and the visible completion.
     total_estimated_output_tokens = num_incidents * ESTIMATED_AVERAGE_OUTPUT_TOKENS_PER_CALL
@@ -166,6 +283,11 @@ def estimate_cost(num_incidents: int, average_input_tokens_per_incident: int) ->
     total_cost = input_cost + output_cost
     return total_cost, total_input_tokens, total_estimated_output_tokens
 
+def percentile(sorted_values: List[int], pct: float) -> int:
+    """Returns the nearest-rank `pct` percentile (0-100) of an ascending, non-empty list."""
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
 def find_narrative_field(incident_sample: Dict[str, Any]) -> str:
     """
     Attempts to automatically find the narrative field in an incident sample.
@@ -181,19 +303,155 @@ def find_narrative_field(incident_sample: Dict[str, Any]) -> str:
     print("Please specify it with --narrative_field. Defaulting to 'Narrative: 1'.")
     return "Narrative: 1"
 
+def make_narrative_extractor(narrative_field_name: str) -> Callable[[Dict[str, Any]], str]:
+    """
+    Returns a function that extracts the narrative text of an incident from `narrative_field_name`.
+    The field may hold a dict with a "text" sub-key or the text itself, either as a string or a list of strings.
+    """
+    def extract_narrative(incident: Dict[str, Any]) -> str:
+        narrative = incident.get(narrative_field_name)
+        if isinstance(narrative, dict):
+            narrative = narrative.get("text", "")
+        if isinstance(narrative, list): # Handle cases where narrative might be a list of strings
+            return "\n".join(narrative)
+        return narrative if isinstance(narrative, str) else ""
+    return extract_narrative
+
+
+# --- Rate Limiting ---
+class RateLimiter:
+    """
+    Async token bucket tracking request and token capacity per minute.
+    Follows the OpenAI Cookbook's api_request_parallel_processor.py: capacity refills
+    continuously, and a 429 from the API pauses all requests for a cooldown period.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+        # The bucket must hold at least one whole request, or rates below 1/minute would never admit one.
+        self.request_bucket_size = max(requests_per_minute, 1)
+        self.available_request_capacity = self.request_bucket_size
+        self.available_token_capacity = tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.cooldown_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60.0,
+            self.request_bucket_size,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, token_cost: int) -> None:
+        """Waits until there is capacity for one request consuming `token_cost` tokens."""
+        # A single request larger than the whole bucket would otherwise wait forever.
+        token_cost = min(token_cost, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.cooldown_until:
+                    await asyncio.sleep(self.cooldown_until - now)
+                    continue
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= token_cost:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= token_cost
+                    return
+                request_wait = (1 - self.available_request_capacity) * 60.0 / self.max_requests_per_minute
+                token_wait = (token_cost - self.available_token_capacity) * 60.0 / self.max_tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+    def pause(self, seconds: float) -> None:
+        """Blocks new requests for `seconds`, e.g. after the API reports a rate limit."""
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: httpx.Headers, token_cost: int) -> None:
+        """
+        Reads the x-ratelimit-* response headers and, only when the server-side request or token
+        budget is nearly used up, pauses new requests until that budget resets.
+        """
+        for resource, low_watermark in (("requests", LOW_REMAINING_REQUESTS), ("tokens", token_cost)):
+            remaining = headers.get(f"x-ratelimit-remaining-{resource}")
+            reset = headers.get(f"x-ratelimit-reset-{resource}")
+            if remaining is None or reset is None:
+                continue
+            try:
+                if int(remaining) < low_watermark:
+                    self.pause(parse_reset_duration(reset))
+            except ValueError:
+                continue
+
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNIT_SECONDS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+def parse_reset_duration(value: str) -> float:
+    """Parses a rate-limit reset header such as "1s", "6m0s" or "20ms" into seconds."""
+    return sum(float(amount) * _DURATION_UNIT_SECONDS[unit] for amount, unit in _DURATION_PART_RE.findall(value))
+
+
+# --- Response Cache ---
+class ResponseCache:
+    """
+    On-disk SQLite cache mapping a hash of the model name and the full prompt to the LLM's raw output text.
+    Only responses that parsed successfully are stored, so failed classifications are retried on the next run.
+    """
+
+    def __init__(self, filepath: str):
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, output_text TEXT NOT NULL)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(input_messages: List[Dict[str, str]]) -> str:
+        return hashlib.sha256((MODEL_NAME + json.dumps(input_messages)).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.connection.execute("SELECT output_text FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, output_text: str) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO responses (key, output_text) VALUES (?, ?)", (key, output_text))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Errors worth retrying; anything else (bad request, auth, ...) fails immediately.
+RETRYABLE_API_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # Includes APITimeoutError
+    openai.InternalServerError,
+)
+
 
 # --- Main Script ---
-def initialize_openai_client():
-    """Initializes and returns the OpenAI client."""
+def initialize_openai_client(concurrency: int = DEFAULT_CONCURRENCY):
+    """Initializes and returns the async OpenAI client."""
     if not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY environment variable not set.")
-    return openai.OpenAI(api_key=OPENAI_API_KEY)
+    # One shared connection pool, sized so every concurrent request can reuse a kept-alive connection.
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    )
+    # Retries are handled by create_response_with_retries so they also go through the rate limiter.
+    return openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=http_client)
 
 def load_incidents(filepath: str) -> List[Dict[str, Any]]:
     """Loads ASRS incidents from a JSON file."""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+        data = json_loads(raw)
         if not isinstance(data, list):
             raise ValueError("Input JSON file should contain a list of incidents.")
         if not data:
@@ -210,16 +468,105 @@ def load_incidents(filepath: str) -> List[Dict[str, Any]]:
         exit(1)
 
 
-def save_incidents(filepath: str, data: List[Dict[str, Any]]):
-    """Saves the processed incidents (with HFACS classifications) to a JSON file."""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
+def save_incidents(filepath: str, data: List[Dict[str, Any]], compact: bool = False):
+    """
+    Saves the processed incidents (with HFACS classifications) to a JSON file.
+    Output is indented for readability unless `compact` is set, which roughly halves file size and write time.
+    """
+    # Write to a temporary file first so an interrupted save never leaves a truncated output file.
+    temp_filepath = filepath + ".tmp"
+    if orjson:
+        with open(temp_filepath, 'wb') as f:
+            f.write(orjson.dumps(data) if compact else orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(temp_filepath, 'w', encoding='utf-8') as f:
+            if compact:
+                json.dump(data, f, separators=(",", ":"))
+            else:
+                json.dump(data, f, indent=2)
+    os.replace(temp_filepath, filepath)
     print(f"\nSuccessfully saved processed incidents to '{filepath}'")
 
-def get_hfacs_classification_from_llm(client: openai.OpenAI, narrative_text: str) -> Tuple[List[Dict[str, Any]], int, int]:
+def load_checkpoint(filepath: str) -> List[Dict[str, Any]]:
+    """
+    Loads the classifications appended to a JSONL checkpoint by an interrupted run.
+    Each line is {"key": <ACN or master list index>, "hfacs_classification": [...]}.
+    """
+    entries = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json_loads(line))
+            except json.JSONDecodeError:
+                # Most likely a line cut short when the previous run was killed mid-write.
+                print(f"Warning: Skipping malformed line {line_number} in checkpoint '{filepath}'.")
+    return entries
+
+async def create_response_with_retries(client: openai.AsyncOpenAI, limiter: RateLimiter, input_messages: List[Dict[str, str]], input_tokens: int, num_narratives: int = 1):
+    """
+    Calls the Responses API once capacity is available, retrying transient failures
+    with exponential backoff and jitter. Raises the last error once retries are exhausted.
+    """
+    token_cost = input_tokens + num_narratives * ESTIMATED_AVERAGE_OUTPUT_TOKENS_PER_CALL
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire(token_cost)
+        try:
+            # The raw response exposes the x-ratelimit-* headers, so throttling only kicks in near the cap.
+            raw_response = await client.responses.with_raw_response.create(
+                model=MODEL_NAME,
+                reasoning={"effort": "medium"},
+                input=input_messages
+            )
+            limiter.update_from_headers(raw_response.headers, token_cost)
+            return raw_response.parse()
+        except RETRYABLE_API_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(RATE_LIMIT_COOLDOWN_SECONDS)
+            delay = RETRY_BASE_DELAY_SECONDS * (2 ** attempt) * (1 + random.random())
+            print(f"  {type(e).__name__} from API, retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})...")
+            await asyncio.sleep(delay)
+
+# Contents of the first Markdown code fence (```json ... ``` or ``` ... ```); an unclosed fence runs to the end.
+_CODE_FENCE_RE = re.compile(r"```(?:json)?[ \t]*\n(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+def extract_json_text(llm_output_text: str) -> str:
+    """Returns the contents of the first Markdown code fence in the LLM output, or the whole output if there is none."""
+    match = _CODE_FENCE_RE.search(llm_output_text)
+    return (match.group(1) if match else llm_output_text).strip()
+
+def parse_llm_json(llm_output_text: str) -> Any:
+    """
+    Parses the LLM output as JSON, falling back to the contents of its first code fence when the
+    output is not bare JSON. Raises json.JSONDecodeError if neither parses.
+    """
+    try:
+        return json_loads(llm_output_text)
+    except json.JSONDecodeError:
+        return json_loads(extract_json_text(llm_output_text))
+
+def build_input_messages(narrative_text: str) -> List[Dict[str, str]]:
+    """Builds the developer and user messages that classify a single narrative."""
+    return [
+        {
+            "role": "developer",
+            "content": HFACS_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": _USER_PREFIX + narrative_text + _USER_SUFFIX
+        }
+    ]
+
+async def get_hfacs_classification_from_llm(client: openai.AsyncOpenAI, narrative_text: str, limiter: RateLimiter, cache: Optional[ResponseCache] = None, input_tokens: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int, int]:
     """
     Sends a narrative to the OpenAI reasoning model and returns the HFACS classification
     along with actual input and output token counts from the API response.
+    A response found in `cache` is reused without an API call and reports zero tokens.
+    `input_tokens` is the prompt's token count when the caller has already computed it.
     """
     actual_input_tokens = 0
     actual_output_tokens = 0 # This will include reasoning + completion tokens
@@ -228,41 +575,37 @@ def get_hfacs_classification_from_llm(client: openai.OpenAI, narrative_text: str
         print("Warning: Empty narrative text provided. Skipping classification.")
         return [], actual_input_tokens, actual_output_tokens
 
-    full_prompt = HFACS_PROMPT_TEMPLATE.format(narrative_text=narrative_text)
-    actual_input_tokens = count_tokens_for_prompt(full_prompt, MODEL_NAME) # Count tokens for the constructed prompt
-
-    try:
-        response = client.responses.create(
-            model=MODEL_NAME,
-            reasoning={"effort": "medium"},
-            input=[
-                {
-                    "role": "user",
-                    "content": full_prompt
-                }
-            ]
-        )
+    actual_input_tokens = input_tokens if input_tokens is not None else count_tokens_for_prompt(narrative_text) # Count tokens for the constructed prompt
 
-        # Extract actual token usage from the API response
-        if response.usage:
-            # The 'input_tokens' in usage might differ slightly from our tiktoken count due to how API packages requests
-            # For cost, API's count is definitive. For our pre-estimation, tiktoken is good.
-            # Let's use our tiktoken count for input cost as it's based on the raw prompt.
-            # The `response.usage.output_tokens` includes both reasoning and visible completion tokens.
-            actual_output_tokens = response.usage.output_tokens or 0
+    input_messages = build_input_messages(narrative_text)
+    cache_key = ResponseCache.make_key(input_messages)
 
+    try:
+        cached_output_text = cache.get(cache_key) if cache else None
+        if cached_output_text is not None:
+            print("  Using cached LLM response; no API call made.")
+            actual_input_tokens = 0 # Nothing is billed for a cached response
+            raw_output_text = cached_output_text
+        else:
+            response = await create_response_with_retries(client, limiter, input_messages, actual_input_tokens)
 
-        llm_output_text = response.output_text
+            # Extract actual token usage from the API response
+            if response.usage:
+                # The 'input_tokens' in usage might differ slightly from our tiktoken count due to how API packages requests
+                # For cost, API's count is definitive. For our pre-estimation, tiktoken is good.
+                # Let's use our tiktoken count for input cost as it's based on the raw prompt.
+                # The `response.usage.output_tokens` includes both reasoning and visible completion tokens.
+                actual_output_tokens = response.usage.output_tokens or 0
+            raw_output_text = response.output_text
 
-        if llm_output_text.strip().startswith("```json"):
-            llm_output_text = llm_output_text.split("```json")[1].split("```")[0].strip()
-        elif llm_output_text.strip().startswith("```"):
-             llm_output_text = llm_output_text.split("```")[1].strip()
+        llm_output_text = raw_output_text.strip()
 
-        parsed_hfacs = json.loads(llm_output_text)
+        parsed_hfacs = parse_llm_json(llm_output_text)
         if not isinstance(parsed_hfacs, list):
             print(f"Warning: LLM did not return a list for HFACS. Output: {llm_output_text}")
             return [{"error": "LLM did not return a list", "raw_output": llm_output_text}], actual_input_tokens, actual_output_tokens
+        if cache and cached_output_text is None:
+            cache.put(cache_key, raw_output_text)
         return parsed_hfacs, actual_input_tokens, actual_output_tokens
 
     except json.JSONDecodeError:
@@ -275,7 +618,112 @@ def get_hfacs_classification_from_llm(client: openai.OpenAI, narrative_text: str
         print(f"An unexpected error occurred during LLM call: {e}")
         return [{"error": f"Unexpected error: {str(e)}"}], actual_input_tokens, actual_output_tokens
 
-def main():
+def serialize_batch_narratives(narratives: List[Tuple[str, str]]) -> str:
+    """
+    Serializes (id, narrative_text) pairs exactly as they are sent in a batch prompt.
+    Non-ASCII text is kept as-is: \\u escapes would cost extra tokens and get echoed back by the model.
+    """
+    return json.dumps([{"id": narrative_id, "text": narrative_text} for narrative_id, narrative_text in narratives], indent=2, ensure_ascii=False)
+
+def make_batches(narratives: List[Tuple[str, str]], batch_size: int, max_batch_input_tokens: int, item_tokens: Dict[str, int]) -> List[List[Tuple[str, str]]]:
+    """
+    Splits (id, narrative_text) pairs into batches of at most `batch_size` narratives whose
+    prompt stays within `max_batch_input_tokens`. A narrative that alone exceeds the budget
+    is sent in a batch of its own. `item_tokens` maps each id to the token count of its
+    serialized batch entry.
+    """
+    narrative_budget = max_batch_input_tokens - _STATIC_BATCH_TEMPLATE_TOKENS
+
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for narrative_id, narrative_text in narratives:
+        narrative_tokens = item_tokens[narrative_id]
+        if current_batch and (len(current_batch) >= batch_size or current_tokens + narrative_tokens > narrative_budget):
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append((narrative_id, narrative_text))
+        current_tokens += narrative_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+def build_batch_input_messages(narratives: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+    """Builds the developer and user messages that classify several (id, narrative_text) pairs at once."""
+    return [
+        {
+            "role": "developer",
+            "content": HFACS_BATCH_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": _BATCH_USER_PREFIX + serialize_batch_narratives(narratives) + _BATCH_USER_SUFFIX
+        }
+    ]
+
+async def get_hfacs_classification_batch(client: openai.AsyncOpenAI, narratives: List[Tuple[str, str]], limiter: RateLimiter, cache: Optional[ResponseCache] = None, input_tokens: Optional[int] = None) -> Tuple[Dict[str, List[Dict[str, Any]]], int, int]:
+    """
+    Sends several (id, narrative_text) pairs to the OpenAI reasoning model in one request and
+    returns a dict mapping each id to its HFACS classification, along with the input and output
+    token counts for the whole request.
+    A response found in `cache` (same batch composition) is reused without an API call and reports zero tokens.
+    `input_tokens` is the prompt's token count when the caller has already computed it.
+    """
+    actual_input_tokens = 0
+    actual_output_tokens = 0 # This will include reasoning + completion tokens
+
+    actual_input_tokens = input_tokens if input_tokens is not None else count_tokens_for_batch_prompt(serialize_batch_narratives(narratives))
+
+    def error_for_all(error: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+        return {narrative_id: [error] for narrative_id, _ in narratives}
+
+    input_messages = build_batch_input_messages(narratives)
+    cache_key = ResponseCache.make_key(input_messages)
+
+    try:
+        cached_output_text = cache.get(cache_key) if cache else None
+        if cached_output_text is not None:
+            print("  Using cached LLM response; no API call made.")
+            actual_input_tokens = 0 # Nothing is billed for a cached response
+            raw_output_text = cached_output_text
+        else:
+            response = await create_response_with_retries(client, limiter, input_messages, actual_input_tokens, num_narratives=len(narratives))
+
+            if response.usage:
+                actual_output_tokens = response.usage.output_tokens or 0
+            raw_output_text = response.output_text
+
+        llm_output_text = raw_output_text.strip()
+
+        parsed_batch = parse_llm_json(llm_output_text)
+        if not isinstance(parsed_batch, dict):
+            print(f"Warning: LLM did not return an object keyed by narrative ID. Output: {llm_output_text}")
+            return error_for_all({"error": "LLM did not return an object keyed by narrative ID", "raw_output": llm_output_text}), actual_input_tokens, actual_output_tokens
+
+        classifications = {}
+        for narrative_id, _ in narratives:
+            parsed_hfacs = parsed_batch.get(narrative_id)
+            if isinstance(parsed_hfacs, list):
+                classifications[narrative_id] = parsed_hfacs
+            else:
+                print(f"Warning: LLM did not return a list for narrative ID {narrative_id}. Output: {parsed_hfacs}")
+                classifications[narrative_id] = [{"error": "LLM did not return a list for this narrative ID", "raw_output": json.dumps(parsed_hfacs)}]
+        if cache and cached_output_text is None and all(isinstance(parsed_batch.get(narrative_id), list) for narrative_id, _ in narratives):
+            cache.put(cache_key, raw_output_text)
+        return classifications, actual_input_tokens, actual_output_tokens
+
+    except json.JSONDecodeError:
+        print(f"Error: Could not parse LLM response as JSON. Raw response: {llm_output_text if 'llm_output_text' in locals() else 'N/A'}")
+        return error_for_all({"error": "Failed to parse LLM JSON response", "raw_output": llm_output_text if 'llm_output_text' in locals() else 'N/A'}), actual_input_tokens, actual_output_tokens
+    except openai.APIError as e:
+        print(f"OpenAI API Error: {e}")
+        return error_for_all({"error": f"OpenAI API Error: {str(e)}"}), actual_input_tokens, actual_output_tokens
+    except Exception as e:
+        print(f"An unexpected error occurred during LLM call: {e}")
+        return error_for_all({"error": f"Unexpected error: {str(e)}"}), actual_input_tokens, actual_output_tokens
+
+async def main():
     parser = argparse.ArgumentParser(description="Classify ASRS incident narratives using HFACS via OpenAI LLM.")
     parser.add_argument("input_file", help="Path to the input JSON file containing ASRS incidents.")
     parser.add_argument("output_file", help="Path to save the output JSON file with HFACS classifications.")
@@ -284,6 +732,16 @@ def main():
     parser.add_argument("--start_index", type=int, default=0, help="Index of the incident to start processing from (0-based).")
     parser.add_argument("--end_index", type=int, default=None, help="Index of the incident to end processing at (exclusive). Processes all if None.")
     parser.add_argument("--estimate_only", action="store_true", help="Only estimate cost and exit without processing.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help=f"Maximum number of concurrent API requests. (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--requests_per_minute", type=float, default=DEFAULT_REQUESTS_PER_MINUTE, help=f"Client-side request rate limit. (default: {DEFAULT_REQUESTS_PER_MINUTE})")
+    parser.add_argument("--tokens_per_minute", type=float, default=DEFAULT_TOKENS_PER_MINUTE, help=f"Client-side token rate limit. (default: {DEFAULT_TOKENS_PER_MINUTE})")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Number of narratives to classify per API request. (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--force", action="store_true", help="Reclassify incidents that already have an HFACS classification in the output file.")
+    parser.add_argument("--compact", action="store_true", help="Write the final output file without indentation. Checkpoint lines are always compact.")
+    parser.add_argument("--cache_file", default=DEFAULT_CACHE_FILE, help=f"SQLite file caching LLM responses across runs. (default: {DEFAULT_CACHE_FILE})")
+    parser.add_argument("--no_cache", action="store_true", help="Neither read from nor write to the response cache.")
+    parser.add_argument("--max_input_tokens", type=int, default=DEFAULT_MAX_INPUT_TOKENS, help=f"Truncate narratives longer than this many tokens before sending them; 0 disables truncation. (default: {DEFAULT_MAX_INPUT_TOKENS})")
+    parser.add_argument("--max_batch_input_tokens", type=int, default=DEFAULT_MAX_BATCH_INPUT_TOKENS, help=f"Input-token budget for a single batched request. (default: {DEFAULT_MAX_BATCH_INPUT_TOKENS})")
 
 
     args = parser.parse_args()
@@ -294,6 +752,10 @@ def main():
         print("Example: export OPENAI_API_KEY='your_api_key_here'")
         return
 
+    if args.concurrency < 1 or args.requests_per_minute <= 0 or args.tokens_per_minute <= 0 or args.batch_size < 1:
+        print("Error: --concurrency, --requests_per_minute, --tokens_per_minute and --batch_size must be positive.")
+        return
+
     incidents = load_incidents(args.input_file)
     total_incidents_in_file = len(incidents)
 
@@ -302,6 +764,7 @@ def main():
     if not narrative_field_name:
         narrative_field_name = find_narrative_field(incidents[0]) # Use first incident to detect
     print(f"Using narrative field: '{narrative_field_name}'")
+    extract_narrative = make_narrative_extractor(narrative_field_name)
 
 
     # Determine processing range
@@ -324,35 +787,6 @@ def main():
 
     print(f"Will process {num_incidents_to_process} incidents (from index {start_idx} to {end_idx-1}).")
 
-    # Cost Estimation
-    # For a more accurate input token estimation, we should calculate it for each specific incident's prompt.
-    # Here, we'll calculate for the first incident to process and use it as an average.
-    first_narrative_to_process = incidents_to_process_list[0].get(narrative_field_name, {}).get("text", "")
-    if isinstance(first_narrative_to_process, list): # Handle cases where narrative might be a list of strings
-        first_narrative_to_process = "\n".join(first_narrative_to_process)
-
-    sample_prompt_for_estimation = HFACS_PROMPT_TEMPLATE.format(narrative_text=first_narrative_to_process)
-    avg_input_tokens = count_tokens_for_prompt(sample_prompt_for_estimation, MODEL_NAME)
-    print(f"Estimated average input tokens per incident (based on first): {avg_input_tokens}")
-
-    estimated_total_cost, est_total_input, est_total_output = estimate_cost(num_incidents_to_process, avg_input_tokens)
-    print(f"--- Cost Estimation for {num_incidents_to_process} incidents ---")
-    print(f"  Estimated Total Input Tokens: {est_total_input:,}")
-    print(f"  Estimated Total Output Tokens (incl. reasoning): {est_total_output:,} (using avg {ESTIMATED_AVERAGE_OUTPUT_TOKENS_PER_CALL} per call)")
-    print(f"  Estimated Total Cost: ${estimated_total_cost:.4f}")
-    print("--------------------------------------")
-
-    if args.estimate_only:
-        print("Exiting after cost estimation as --estimate_only was specified.")
-        return
-
-    confirmation = input("Do you want to proceed with processing? (yes/no): ")
-    if confirmation.lower() != 'yes':
-        print("Processing aborted by user.")
-        return
-
-    client = initialize_openai_client()
-    
     # Load existing output data if resuming/appending
     if os.path.exists(args.output_file):
         print(f"Loading existing data from '{args.output_file}' to update/append.")
@@ -361,74 +795,206 @@ def main():
         print(f"Output file '{args.output_file}' not found. A new file will be created.")
         all_incidents_data = list(incidents) # Start with a copy of all input incidents
 
-    # Create a dictionary for faster lookups if 'ACN' exists
+    # Map each incident's key (its ACN, or its list index when it has none) directly to its record.
     # This is important for correctly updating the `all_incidents_data` list
     # which might be from a previous run and already contain some HFACS classifications.
-    incident_map = {}
-    has_acn = all("ACN" in incident for incident in all_incidents_data) # Check if all incidents have ACN
-    
-    if has_acn:
-        for idx, incident in enumerate(all_incidents_data):
-            incident_map[incident["ACN"]] = idx
-    else:
-        print("Warning: Not all incidents have an 'ACN' field. Updates will be based on list index, which is less robust if input order changes between runs.")
-
-
-    actual_total_input_tokens_processed = 0
-    actual_total_output_tokens_processed = 0
-
+    incident_map = {incident.get("ACN") or idx: incident for idx, incident in enumerate(all_incidents_data)}
+    if len(incident_map) < len(all_incidents_data) or any(not incident.get("ACN") for incident in all_incidents_data):
+        print("Warning: Not all incidents have a unique 'ACN' field. Incidents without one are matched by list index, which is less robust if input order changes between runs.")
+
+    # Completed classifications are appended to a JSONL checkpoint as they arrive, instead of
+    # rewriting the whole output file. The full JSON output is only written once at the end.
+    checkpoint_path = args.output_file + ".jsonl"
+    if os.path.exists(checkpoint_path):
+        restored_count = 0
+        for entry in load_checkpoint(checkpoint_path):
+            target_incident_in_master_list = incident_map.get(entry.get("key"))
+            if target_incident_in_master_list is not None:
+                target_incident_in_master_list["hfacs_classification"] = entry.get("hfacs_classification", [])
+                restored_count += 1
+        print(f"Restored {restored_count} classifications from checkpoint '{checkpoint_path}'.")
+
+    # Resolve every incident in the slice to its record in the master list and its narrative.
+    # Each pending entry is (incident_id_for_log, original_incident_idx, incident_key, target_incident_in_master_list, narrative).
+    pending_incidents = []
+    already_classified_count = 0
     for current_processing_idx, incident_from_slice in enumerate(incidents_to_process_list):
         # Determine the original index or ACN of the incident
         original_incident_idx = start_idx + current_processing_idx
         incident_id_for_log = incident_from_slice.get("ACN", f"original_index_{original_incident_idx}")
 
-        print(f"\nProcessing Incident {current_processing_idx+1}/{num_incidents_to_process} (ID: {incident_id_for_log}, Original Index: {original_incident_idx})...")
-
         # Find the incident in our master list `all_incidents_data` to update it
-        target_incident_in_master_list = None
-        if has_acn and incident_from_slice.get("ACN") in incident_map:
-            master_list_idx = incident_map[incident_from_slice["ACN"]]
-            target_incident_in_master_list = all_incidents_data[master_list_idx]
-        elif not has_acn and original_incident_idx < len(all_incidents_data): # Fallback to index
-            target_incident_in_master_list = all_incidents_data[original_incident_idx]
-        else:
+        incident_key = incident_from_slice.get("ACN") or original_incident_idx
+        target_incident_in_master_list = incident_map.get(incident_key)
+        if target_incident_in_master_list is None:
             print(f"Error: Could not find incident {incident_id_for_log} in master data. Skipping.")
             continue
 
+        # Incidents classified by a previous run (or restored from the checkpoint) are not sent again.
+        # Classifications containing an error entry are retried.
+        existing_classification = target_incident_in_master_list.get("hfacs_classification")
+        if existing_classification and not args.force and not any(isinstance(item, dict) and "error" in item for item in existing_classification):
+            already_classified_count += 1
+            continue
 
-        narrative_obj = target_incident_in_master_list.get(narrative_field_name)
-        narrative = ""
-        if isinstance(narrative_obj, dict):
-            narrative = narrative_obj.get("text", "")
-        elif isinstance(narrative_obj, str): # if narrative_field itself is the string
-            narrative = narrative_obj
-
-        if isinstance(narrative, list): # Handle cases where narrative might be a list of strings
-            narrative = "\n".join(narrative)
-
+        narrative = extract_narrative(target_incident_in_master_list)
         if not narrative or not narrative.strip():
             print(f"Warning: No narrative found or narrative is empty for incident ID {incident_id_for_log} using field '{narrative_field_name}'. Adding empty classification.")
             target_incident_in_master_list["hfacs_classification"] = []
         else:
-            hfacs_data, in_tokens, out_tokens = get_hfacs_classification_from_llm(client, narrative)
-            target_incident_in_master_list["hfacs_classification"] = hfacs_data
-            actual_total_input_tokens_processed += in_tokens
-            actual_total_output_tokens_processed += out_tokens
-            print(f"  LLM classification for {incident_id_for_log}: {json.dumps(hfacs_data, indent=1)}")
-            print(f"  API reported tokens for this call -> Input: {in_tokens}, Output: {out_tokens}")
+            pending_incidents.append((str(incident_id_for_log), original_incident_idx, incident_key, target_incident_in_master_list, narrative))
+
+    # Tokenize every pending narrative once; the counts are reused for the estimate and at request time.
+    pending_narratives = [narrative for _, _, _, _, narrative in pending_incidents]
+    sent_narratives, narrative_token_counts = truncate_to_token_budget(pending_narratives, args.max_input_tokens)
+    narrative_tokens_by_id = {}
+    for pending_idx, (narrative, sent_narrative, token_count) in enumerate(zip(pending_narratives, sent_narratives, narrative_token_counts)):
+        incident_id = pending_incidents[pending_idx][0]
+        if sent_narrative is not narrative:
+            print(f"Warning: Narrative for incident ID {incident_id} exceeds {args.max_input_tokens} tokens and was truncated.")
+            pending_incidents[pending_idx] = pending_incidents[pending_idx][:4] + (sent_narrative,)
+        narrative_tokens_by_id[incident_id] = token_count
+
+    if already_classified_count:
+        print(f"Skipping {already_classified_count} incidents that already have an HFACS classification (use --force to reclassify them).")
+
+    # Identical narratives (e.g. boilerplate or reissued reports) are sent once and the result is shared.
+    unique_narratives = [] # (incident_id, narrative) of the first incident with each distinct narrative
+    duplicate_ids = {} # incident_id of that first incident -> ids of later incidents with the same narrative
+    first_id_by_hash = {}
+    for incident_id, _, _, _, narrative in pending_incidents:
+        narrative_hash = hashlib.blake2b(narrative.encode(), digest_size=16).hexdigest()
+        if narrative_hash in first_id_by_hash:
+            duplicate_ids.setdefault(first_id_by_hash[narrative_hash], []).append(incident_id)
+        else:
+            first_id_by_hash[narrative_hash] = incident_id
+            unique_narratives.append((incident_id, narrative))
+    if len(unique_narratives) < len(pending_incidents):
+        print(f"{len(pending_incidents) - len(unique_narratives)} incidents share an identical narrative with another; each distinct narrative is classified once.")
+
+    if not unique_narratives:
+        print("No incidents in the selected range need classification; nothing will be sent to the API.")
+        if args.estimate_only:
+            return
+        # Still write the output so restored checkpoint entries and empty classifications are kept.
+        save_incidents(args.output_file, all_incidents_data, compact=args.compact)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return
 
+    cache = None if args.no_cache else ResponseCache(args.cache_file)
+
+    if args.batch_size > 1:
+        # In batch mode each narrative is sent as a JSON object, and the fixed instructions
+        # are shared by up to batch_size narratives. The serialized entries are tokenized once
+        # here and reused for batching and request accounting.
+        item_token_counts = count_tokens_for_texts([serialize_batch_narratives([(incident_id, narrative)]) for incident_id, narrative in unique_narratives])
+        item_tokens_by_id = {incident_id: token_count for (incident_id, _), token_count in zip(unique_narratives, item_token_counts)}
+        static_tokens_per_incident = -(-_STATIC_BATCH_TEMPLATE_TOKENS // args.batch_size)
+        narrative_batches = make_batches(unique_narratives, args.batch_size, args.max_batch_input_tokens, item_tokens_by_id)
+        print(f"Grouped {len(unique_narratives)} narratives into {len(narrative_batches)} batched requests.")
+    else:
+        item_tokens_by_id = narrative_tokens_by_id
+        static_tokens_per_incident = _STATIC_TEMPLATE_TOKENS
+        narrative_batches = [[(incident_id, narrative)] for incident_id, narrative in unique_narratives]
+
+    # Requests whose exact prompt is already in the response cache are answered without an API call.
+    cached_ids = set()
+    if cache:
+        for batch in narrative_batches:
+            input_messages = build_batch_input_messages(batch) if args.batch_size > 1 else build_input_messages(batch[0][1])
+            if cache.get(ResponseCache.make_key(input_messages)) is not None:
+                cached_ids.update(incident_id for incident_id, _ in batch)
+        if cached_ids:
+            print(f"{len(cached_ids)} distinct narratives have a cached response and will not be sent to the API.")
+
+    # Cost Estimation
+    # Count input tokens for each distinct narrative that will actually be sent, reusing the counts from truncation.
+    input_token_counts = [static_tokens_per_incident + item_tokens_by_id[incident_id] for incident_id, _ in unique_narratives if incident_id not in cached_ids]
+    num_incidents_to_estimate = len(input_token_counts)
+    if num_incidents_to_estimate:
+        # The distribution matters for budgeting: a few very long narratives can dominate the total.
+        sorted_counts = sorted(input_token_counts)
+        print(f"Estimated average input tokens per incident: {sum(input_token_counts) // num_incidents_to_estimate}")
+        print(f"Input tokens per incident: p50 {percentile(sorted_counts, 50):,}, p95 {percentile(sorted_counts, 95):,}, max {sorted_counts[-1]:,}")
+
+        estimated_total_cost, est_total_input, est_total_output = estimate_cost(num_incidents_to_estimate, sum(input_token_counts))
+        print(f"--- Cost Estimation for {num_incidents_to_estimate} distinct narratives to send to the API ---")
+        print(f"  Estimated Total Input Tokens: {est_total_input:,}")
+        print(f"  Estimated Total Output Tokens (incl. reasoning): {est_total_output:,} (using avg {ESTIMATED_AVERAGE_OUTPUT_TOKENS_PER_CALL} per call)")
+        print(f"  Estimated Total Cost: ${estimated_total_cost:.4f}")
+        print("--------------------------------------")
+
+    if args.estimate_only:
+        print("Exiting after cost estimation as --estimate_only was specified.")
+        return
+
+    # Nothing is billed when every request is answered from the cache, so there is nothing to confirm.
+    if num_incidents_to_estimate:
+        confirmation = input("Do you want to proceed with processing? (yes/no): ")
+        if confirmation.lower() != 'yes':
+            print("Processing aborted by user.")
+            return
 
-        if (current_processing_idx + 1) % 5 == 0 or (current_processing_idx + 1) == num_incidents_to_process:
-            print(f"\nSaving progress to '{args.output_file}'...")
-            save_incidents(args.output_file, all_incidents_data)
+    client = initialize_openai_client(args.concurrency)
 
-        print(f"Waiting {REQUEST_DELAY_SECONDS}s before next request...")
-        time.sleep(REQUEST_DELAY_SECONDS)
+    actual_total_input_tokens_processed = 0
+    actual_total_output_tokens_processed = 0
+    completed_count = 0
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+
+    pending_by_id = {incident_id: (original_incident_idx, incident_key, target) for incident_id, original_incident_idx, incident_key, target, _ in pending_incidents}
+    num_requests = len(narrative_batches)
+
+    async def classify_batch(request_idx: int, batch: List[Tuple[str, str]]) -> None:
+        nonlocal actual_total_input_tokens_processed, actual_total_output_tokens_processed, completed_count
+
+        async with semaphore:
+            if args.batch_size > 1:
+                print(f"\nProcessing Request {request_idx+1}/{num_requests} ({len(batch)} incidents, IDs: {', '.join(incident_id for incident_id, _ in batch)})...")
+                classifications, in_tokens, out_tokens = await get_hfacs_classification_batch(client, batch, limiter, cache, _STATIC_BATCH_TEMPLATE_TOKENS + sum(item_tokens_by_id[incident_id] for incident_id, _ in batch))
+            else:
+                incident_id, narrative = batch[0]
+                print(f"\nProcessing Incident {request_idx+1}/{num_requests} (ID: {incident_id}, Original Index: {pending_by_id[incident_id][0]})...")
+                hfacs_data, in_tokens, out_tokens = await get_hfacs_classification_from_llm(client, narrative, limiter, cache, _STATIC_TEMPLATE_TOKENS + narrative_tokens_by_id[incident_id])
+                classifications = {incident_id: hfacs_data}
+
+        actual_total_input_tokens_processed += in_tokens
+        actual_total_output_tokens_processed += out_tokens
+        for incident_id, hfacs_data in classifications.items():
+            print(f"  LLM classification for {incident_id}: {json.dumps(hfacs_data, indent=1)}")
+            if incident_id in duplicate_ids:
+                print(f"  Reusing it for incidents with an identical narrative: {', '.join(duplicate_ids[incident_id])}")
+            for classified_id in [incident_id] + duplicate_ids.get(incident_id, []):
+                _, incident_key, target_incident_in_master_list = pending_by_id[classified_id]
+                target_incident_in_master_list["hfacs_classification"] = hfacs_data
+                checkpoint_file.write(json_dumps_compact({"key": incident_key, "hfacs_classification": hfacs_data}) + "\n")
+                completed_count += 1
+        checkpoint_file.flush()
+        print(f"  API reported tokens for this call -> Input: {in_tokens}, Output: {out_tokens}")
+
+        print(f"  Progress: {completed_count}/{len(pending_incidents)} incidents classified (checkpointed to '{checkpoint_path}').")
+
+    # Requests run concurrently, bounded by the semaphore and the rate limiter.
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint_file:
+        if checkpoint_file.tell() > 0:
+            checkpoint_file.write("\n") # Terminate a line possibly cut short by an interrupted run; blank lines are skipped on load
+        tasks = [classify_batch(request_idx, batch) for request_idx, batch in enumerate(narrative_batches)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    await client.close()
+    if cache:
+        cache.close()
+    for request_idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Error: Request {request_idx+1}/{num_requests} failed: {result}")
 
     print("\n--- All specified incidents processed. ---")
-    # Final save
+    # Final save; the checkpoint is no longer needed once the full output is on disk.
     print(f"Saving final output to '{args.output_file}'...")
-    save_incidents(args.output_file, all_incidents_data)
+    save_incidents(args.output_file, all_incidents_data, compact=args.compact)
+    os.remove(checkpoint_path)
 
     # Final Cost Calculation based on actual API usage
     final_input_cost = (actual_total_input_tokens_processed / 1_000_000) * INPUT_COST_PER_MILLION_TOKENS
@@ -436,7 +1002,9 @@ def main():
     actual_total_cost = final_input_cost + final_output_cost
 
     print("\n--- Actual Cost Summary ---")
-    print(f"  Total Incidents Processed: {num_incidents_to_process}")
+    print(f"  Total Incidents Classified: {completed_count}")
+    if already_classified_count:
+        print(f"  Incidents Skipped (already classified): {already_classified_count}")
     print(f"  Actual Total Input Tokens (sum of tiktoken counts per prompt): {actual_total_input_tokens_processed:,}")
     print(f"  Actual Total Output Tokens (sum from API, incl. reasoning): {actual_total_output_tokens_processed:,}")
     print(f"  Actual Total Cost: ${actual_total_cost:.4f}")
@@ -444,4 +1012,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())